@@ -1,8 +1,8 @@
 from ._funcs import docker_build, docker_stop, docker_push_to_ecr, docker_run, \
     lambda_function_update, lambda_function_wait_updated, ecr_delete_images_all, \
-    ecr_delete_images_by_json, print_header, set_header_prefix, \
+    ecr_delete_images_by_json, ecr_tag_image, print_header, set_header_prefix, \
     aws_create_credentials_file, aws_get_default_credentials_file_path, \
-    aws_create_credentials_file_on_need, \
-    runcp
+    aws_create_credentials_file_on_need, aws_invalidate_credentials_cache, \
+    runcp, runcp_async, set_use_boto3
 
 from ._pipeline import LambdaDockerPipeline, Stage
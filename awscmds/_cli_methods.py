@@ -2,22 +2,28 @@ import inspect
 import os
 import sys
 import textwrap
+import unittest
 from inspect import signature
-from typing import Callable, Optional
+from types import FrameType
+from typing import Callable, Optional, Set, Dict, List
 
 
 # todo package?
 
-def _frame_to_funcname(frame_info: inspect.FrameInfo) -> str:
-    """Returns module.function or module.class.function"""
-    # todo test
-    if not isinstance(frame_info, inspect.FrameInfo):
-        raise TypeError
-    module = inspect.getmodule(frame_info.frame)
-    if module is None:
-        return frame_info.function  # test
-    module_name = module.__name__
-    return f'{module_name}.{frame_info.function}'
+def _stack_funcnames() -> Set[str]:
+    """Returns module.function for every function on the call stack."""
+    # walking the frames directly is much cheaper than inspect.stack(),
+    # that also reads source files
+    result = set()
+    frame: Optional[FrameType] = sys._getframe(1)  # pylint: disable=protected-access
+    while frame is not None:
+        module_name = frame.f_globals.get('__name__')
+        if module_name is None:
+            result.add(frame.f_code.co_name)
+        else:
+            result.add(f'{module_name}.{frame.f_code.co_name}')
+        frame = frame.f_back
+    return result
 
 
 def _func_to_funcname(func: Callable) -> str:
@@ -28,52 +34,133 @@ def _func_to_funcname(func: Callable) -> str:
     return f'{func.__module__}.{func.__name__}'
 
 
+def _has_args(method: Callable) -> bool:
+    """Returns True if the method (or function) has any parameters
+    besides `self`."""
+    func = getattr(method, '__func__', method)
+    code = getattr(func, '__code__', None)
+    # 0x0C is CO_VARARGS | CO_VARKEYWORDS (*args or **kwargs)
+    if code is None or code.co_kwonlyargcount or code.co_flags & 0x0C:
+        return bool(signature(method).parameters)
+    self_args = 1 if inspect.ismethod(method) else 0
+    return code.co_argcount - self_args > 0
+
+
+class TestHasArgs(unittest.TestCase):
+    class Sample:
+        def no_args(self):
+            pass
+
+        def with_arg(self, x):
+            pass
+
+        def with_default(self, x=1):
+            pass
+
+        def keyword_only(self, *, x):
+            pass
+
+        def var_args(self, *args):
+            pass
+
+        @classmethod
+        def class_method(cls):
+            pass
+
+        @staticmethod
+        def static_method():
+            pass
+
+        @staticmethod
+        def static_method_with_arg(x):
+            pass
+
+    class CallableObject:
+        def __call__(self):
+            pass
+
+    def test_methods(self):
+        obj = self.Sample()
+        self.assertFalse(_has_args(obj.no_args))
+        self.assertTrue(_has_args(obj.with_arg))
+        self.assertTrue(_has_args(obj.with_default))
+        self.assertTrue(_has_args(obj.keyword_only))
+        self.assertTrue(_has_args(obj.var_args))
+
+    def test_class_and_static_methods(self):
+        obj = self.Sample()
+        self.assertFalse(_has_args(obj.class_method))
+        self.assertFalse(_has_args(obj.static_method))
+        self.assertTrue(_has_args(obj.static_method_with_arg))
+
+    def test_without_code(self):
+        self.assertFalse(_has_args(self.CallableObject()))
+
+
 def _minimize_spaces(s):
     return " ".join(s.split())
 
 
-def methods_cli(obj: object, exit=True) -> None:
-    """Converts an object to an application CLI.
+# class -> names of its attributes that are public methods without args
+_command_attr_names_cache: Dict[type, List[str]] = {}
 
-    Every public method of the object that does not require arguments becomes
-    a command to run.
-    """
 
-    stack_funcnames = {_frame_to_funcname(frame_info) for frame_info in
-                       inspect.stack()}
+def _command_attr_names(obj: object) -> List[str]:
+    """Returns the names of the object's public methods that do not require
+    args. The result is computed once per class."""
+    cls = type(obj)
+    cached = _command_attr_names_cache.get(cls)
+    if cached is not None:
+        return cached
 
-    # finding all public methods that do not require args
-    methods = []
-    for x in dir(obj):
-        method = getattr(obj, x)
-        # skipping non-methods
-        if not callable(method):
+    names = []
+    for x in dir(cls):
+        # skipping non-methods. Checking the class attribute first, so
+        # that properties are not evaluated
+        if not callable(getattr(cls, x)):
             continue
+        method = getattr(obj, x)
         # skipping private methods
         if method.__name__.startswith("_"):
             continue
         # skipping constructor
-        if method.__name__ == obj.__class__.__name__:
+        if method.__name__ == cls.__name__:
             continue
-
-        # skipping all the functions the actually calling this function now.
-        # So if an object defines .main(self) method that calls
-        # methods_cli(self), the .main() method will not be a command
-        if _func_to_funcname(method) in stack_funcnames:
+        if _has_args(method):
             continue
+        names.append(x)
+
+    _command_attr_names_cache[cls] = names
+    return names
+
+
+def methods_cli(obj: object, exit=True) -> None:
+    """Converts an object to an application CLI.
+
+    Every public method of the object that does not require arguments becomes
+    a command to run.
+    """
 
-        if signature(method).parameters:  # if has args
+    stack_funcnames = _stack_funcnames()
+
+    # skipping all the functions the actually calling this function now.
+    # So if an object defines .main(self) method that calls
+    # methods_cli(self), the .main() method will not be a command
+    commands: Dict[str, Callable] = {}
+    for x in _command_attr_names(obj):
+        method = getattr(obj, x)
+        if _func_to_funcname(method) in stack_funcnames:
             continue
-        methods.append(method)
+        commands[method.__name__] = method
 
     command: Optional[str] = None
     if len(sys.argv) >= 2:
         command = sys.argv[1].strip().replace('-', '_')
-        for method in methods:
-            if command == method.__name__:
-                method()
-                if exit:
-                    sys.exit(0)
+        selected = commands.get(command)
+        if selected is not None:
+            selected()
+            if exit:
+                sys.exit(0)
 
     print(f"Usage: {os.path.basename(sys.argv[0])} COMMAND")
     if command is not None:
@@ -81,7 +168,8 @@ def methods_cli(obj: object, exit=True) -> None:
         print(f"Unexpected command: '{command}'")
     print()
     print("Commands:")
-    for method in methods:
+    # docstrings are only formatted when the help is actually printed
+    for method in commands.values():
         if method.__doc__:
             doc = _minimize_spaces(method.__doc__)
         else:
@@ -90,3 +178,7 @@ def methods_cli(obj: object, exit=True) -> None:
         if doc:
             print(textwrap.indent(textwrap.fill(doc, 60), ' ' * 4))
     sys.exit(2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,29 @@
 # SPDX-FileCopyrightText: (c) 2021 Artёm IG <github.com/rtmigo>
 # SPDX-License-Identifier: MIT
 
+import asyncio
+import base64
+import codecs
+import datetime
+import functools
+import itertools
 import json
+import math
+import os
+import random
 import re
+import shutil
+import subprocess
 import sys
-import textwrap
+import tempfile
+import threading
 import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from subprocess import Popen, PIPE, CalledProcessError, \
-    check_output, CompletedProcess, STDOUT
-from typing import List, Union, Optional, Sequence, IO, Any, Dict
+    CompletedProcess, STDOUT
+from typing import List, Union, Optional, Sequence, IO, Any, Dict, Tuple
 
 
 ################################################################################
@@ -20,14 +33,9 @@ class HeaderPrinter:
 
     @classmethod
     def print_header(cls, s: str) -> None:
-        print()
-        print('/' * 80)
-        if cls.prefix is not None:
-            print('  ' + cls.prefix)
-
-        print('  ' + s.upper())
-        print('/' * 80)
-        print()
+        line = '/' * 80
+        prefix = '  ' + cls.prefix + '\n' if cls.prefix is not None else ''
+        sys.stdout.write(f'\n{line}\n{prefix}  {s.upper()}\n{line}\n\n')
 
 
 print_header = HeaderPrinter.print_header
@@ -39,65 +47,276 @@ def set_header_prefix(prefix: str):
 
 ################################################################################
 
+_CHUNK_SIZE = 65536
+
+# validated once, so the output is decoded with a known codec name
+_DEFAULT_ENCODING = codecs.lookup(
+    getattr(sys.stdout, 'encoding', None) or 'utf-8').name
+
+
+def _write_stdout_bytes(chunk: bytes, encoding: str, errors: str) -> None:
+    # sys.stdout may be replaced by an object without the binary buffer
+    # (for example, when the output is captured by a test runner)
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is not None:
+        buffer.write(chunk)
+        buffer.flush()
+    else:
+        sys.stdout.write(chunk.decode(encoding, errors))
+        sys.stdout.flush()
+
+
+def _feed_input(pipe: IO[bytes], data: bytes) -> None:
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass  # the process exited without reading everything
+    try:
+        pipe.close()
+    except BrokenPipeError:
+        pass
+
+
 def runcp(args: Sequence[str],
           check=False,
           stdin: Optional[IO[Any]] = None,
-          encoding: str = sys.stdout.encoding,
+          encoding: str = _DEFAULT_ENCODING,
           errors='replace',
-          env: Optional[Dict[str, str]] = None
+          env: Optional[Dict[str, str]] = None,
+          input: Optional[bytes] = None,
+          echo: bool = True
           ) -> CompletedProcess:
-    stdout_lines = []
+    """Runs the process, printing its output in real time and also
+    returning it as `CompletedProcess.stdout`.
+
+    The output is read from the binary pipe in chunks rather than lines,
+    and decoded once when the process is done.
+
+    If `input` is specified, it is written to the process stdin, as in
+    `subprocess.run`. With `echo=False` the output is only captured.
+    """
+    if input is not None:
+        if stdin is not None:
+            raise ValueError('stdin and input arguments may not both be used')
+        stdin = PIPE  # type: ignore
+
+    sys.stdout.flush()  # keeping our own prints before the child's output
+    output = bytearray()
     with Popen(args,
                stdout=PIPE,
                stderr=STDOUT,
                stdin=stdin,
-               bufsize=1,
-               encoding=encoding,
-               errors=errors,
-                env=env
+               bufsize=-1,
+               env=env
                ) as process:
         assert process.stdout is not None
 
+        # writing the input from another thread, so that the process
+        # does not block on a full stdout pipe while we are writing
+        feeder: Optional[threading.Thread] = None
+        if input is not None:
+            assert process.stdin is not None
+            feeder = threading.Thread(target=_feed_input,
+                                      args=(process.stdin, input),
+                                      daemon=True)
+            feeder.start()
+
+        fd = process.stdout.fileno()
         while True:
-            output = process.stdout.readline()
-            assert isinstance(output, str)
-            stdout_lines.append(output)
-            if output == '' and process.poll() is not None:
+            chunk = os.read(fd, _CHUNK_SIZE)
+            if not chunk:
                 break
-            if len(output) > 0:
-                print(output, flush=True, end='')
+            output.extend(chunk)
+            if echo:
+                _write_stdout_bytes(chunk, encoding, errors)
 
+        if feeder is not None:
+            feeder.join()
         exit_code = process.wait()
 
-        stdout_text = '\n'.join(stdout_lines)
+    stdout_text = output.decode(encoding, errors)
+
+    if check and exit_code != 0:
+        raise CalledProcessError(returncode=exit_code, cmd=args,
+                                 output=stdout_text)
+
+    return CompletedProcess(args=args, returncode=exit_code,
+                            stdout=stdout_text)
+
+
+async def runcp_async(args: Sequence[str],
+                      check=False,
+                      stdin: Optional[IO[Any]] = None,
+                      encoding: str = _DEFAULT_ENCODING,
+                      errors='replace',
+                      env: Optional[Dict[str, str]] = None,
+                      input: Optional[bytes] = None,
+                      echo: bool = True
+                      ) -> CompletedProcess:
+    """Asynchronous version of `runcp`, for callers that run several
+    processes concurrently with `asyncio.gather`."""
+    if input is not None:
+        if stdin is not None:
+            raise ValueError('stdin and input arguments may not both be used')
+        stdin = PIPE  # type: ignore
+
+    sys.stdout.flush()  # keeping our own prints before the child's output
+    output = bytearray()
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=PIPE,
+        stderr=STDOUT,
+        stdin=stdin,
+        env=env)
+    assert process.stdout is not None
+
+    async def feed_input():
+        if input is None:
+            return
+        assert process.stdin is not None
+        try:
+            process.stdin.write(input)
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the process exited without reading everything
+        process.stdin.close()
+
+    async def read_output():
+        assert process.stdout is not None
+        while True:
+            chunk = await process.stdout.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            output.extend(chunk)
+            if echo:
+                _write_stdout_bytes(chunk, encoding, errors)
+
+    await asyncio.gather(feed_input(), read_output())
+    exit_code = await process.wait()
 
-        if check and exit_code != 0:
-            raise CalledProcessError(returncode=exit_code, cmd=args,
-                                     output=stdout_text)
+    stdout_text = output.decode(encoding, errors)
 
-        return CompletedProcess(args=args, returncode=exit_code,
-                                stdout=stdout_text)
+    if check and exit_code != 0:
+        raise CalledProcessError(returncode=exit_code, cmd=args,
+                                 output=stdout_text)
+
+    return CompletedProcess(args=args, returncode=exit_code,
+                            stdout=stdout_text)
+
+
+class TestRuncp(unittest.TestCase):
+    def test_output(self):
+        self.assertEqual(runcp(['printf', 'a\nb\n']).stdout, 'a\nb\n')
+
+    def test_input(self):
+        self.assertEqual(runcp(['cat'], input=b'x').stdout, 'x')
+
+    def test_input_not_read(self):
+        cp = runcp(['head', '-c', '5'], input=b'x' * 10_000_000)
+        self.assertEqual(cp.stdout, 'xxxxx')
+
+    def test_no_echo(self):
+        self.assertEqual(runcp(['printf', 'x'], echo=False).stdout, 'x')
+
+    def test_inside_event_loop(self):
+        async def run():
+            return runcp(['printf', 'x']).stdout
+
+        self.assertEqual(asyncio.run(run()), 'x')
+
+    def test_async(self):
+        cp = asyncio.run(runcp_async(['cat'], input=b'a\nb\n'))
+        self.assertEqual(cp.stdout, 'a\nb\n')
+
+    def test_check_raises_with_stderr(self):
+        with self.assertRaises(CalledProcessError) as ctx:
+            check_call_rt(['sh', '-c', 'echo err >&2; exit 3'])
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.output, 'err\n')
 
 
 ################################################################################
 
+# resolved once instead of searching PATH on every call
+_DOCKER = shutil.which('docker') or 'docker'
+_AWS = shutil.which('aws') or 'aws'
+
+
+class AwsBackend:
+    # When boto3 is installed, ECR and Lambda calls are made in-process by
+    # long-lived clients instead of starting the `aws` CLI every time.
+    # Setting it to False forces the CLI.
+    use_boto3: bool = True
+
+
+def set_use_boto3(enabled: bool):
+    AwsBackend.use_boto3 = enabled
+
+
+@functools.lru_cache(maxsize=1)
+def _is_boto3_installed() -> bool:
+    try:
+        import boto3  # pylint: disable=unused-import
+        return True
+    except ImportError:
+        return False
+
+
+def _use_boto3() -> bool:
+    return AwsBackend.use_boto3 and _is_boto3_installed()
 
-def check_call_rt(args: Sequence[str], stdin: Optional[IO[Any]] = None):
-    return runcp(args, check=True, stdin=stdin)
+
+# creating clients from the default boto3 session is not thread-safe
+_aws_clients_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _create_aws_client(service: str, region: str) -> Any:
+    import boto3  # pylint: disable=import-error
+    return boto3.client(service, region_name=region)
+
+
+def _aws_client(service: str, region: str) -> Any:
+    with _aws_clients_lock:
+        return _create_aws_client(service, region)
+
+
+def _ecr_client(region: str) -> Any:
+    return _aws_client('ecr', region)
+
+
+def _lambda_client(region: str) -> Any:
+    return _aws_client('lambda', region)
+
+
+def check_call_rt(args: Sequence[str], stdin: Optional[IO[Any]] = None,
+                  input: Optional[bytes] = None, echo: bool = True):
+    return runcp(args, check=True, stdin=stdin, input=input, echo=echo)
+
+
+def _to_args(item: Union[None, str, List[str], Tuple[str, ...]]) \
+        -> Sequence[str]:
+    if isinstance(item, str):
+        return (item,)
+    if item is None:
+        return ()
+    if isinstance(item, (list, tuple)):
+        return item
+    raise TypeError(item)
 
 
 def _combine(items: List) -> List[str]:
-    args: List[str] = list()
-    for item in items:
-        if isinstance(item, str):
-            args.append(item)
-        elif isinstance(item, (list, tuple)):
-            args.extend(item)
-        elif item is None:
-            continue
-        else:
-            raise TypeError(item)
-    return args
+    return list(itertools.chain.from_iterable(map(_to_args, items)))
+
+
+class TestCombine(unittest.TestCase):
+    def test(self):
+        self.assertEqual(_combine(['a', None, ['b', 'c'], ('d',), 'e']),
+                         ['a', 'b', 'c', 'd', 'e'])
+
+    def test_wrong_type(self):
+        with self.assertRaises(TypeError):
+            _combine(['a', 1])
 
 
 def _is_docker_build_too_many_requests(cp: CompletedProcess) -> bool:
@@ -105,32 +324,47 @@ def _is_docker_build_too_many_requests(cp: CompletedProcess) -> bool:
     # "Step 1/8 : FROM public.ecr.aws/lambda/python:3.8 AS base-image
     #  toomanyrequests: Rate exceeded"
     tmr = 'toomanyrequests: Rate exceeded'
-    # (tmr in cp.stdout or tmr in cp.stderr)
-    return cp.returncode != 0 and tmr in cp.stderr
+    # runcp merges stderr into stdout
+    return cp.returncode != 0 and tmr in cp.stdout
 
 
 def docker_build(source_dir: Path, image_name: str,
                  docker_file: Path = None,
-                 tmr_timeout: float = 30) -> None:
+                 tmr_timeout: float = 30,
+                 cache_from: Optional[str] = None) -> None:
+    """
+    :param cache_from: an image (for example, the last pushed one) whose
+        layers can be reused. Enables BuildKit, and embeds the cache metadata
+        into the built image, so that it can serve as the cache next time.
+        If the image cannot be pulled, Docker just builds without it.
+    """
     start_time = time.monotonic()
 
     print_header(f'Building docker image {image_name}')
     args = _combine([
-        'docker', 'build', '-t', image_name,
+        _DOCKER, 'build', '-t', image_name,
         ['-f', str(docker_file)] if docker_file else None,
+        ['--cache-from', cache_from,
+         '--build-arg', 'BUILDKIT_INLINE_CACHE=1'] if cache_from else None,
         str(source_dir)
     ])
+    env = {**os.environ, 'DOCKER_BUILDKIT': '1'} if cache_from else None
 
+    # exponential backoff with jitter, so that parallel jobs hitting
+    # the same rate limit do not retry in sync
+    delay = 1.0
     while True:
         # pylint: disable=subprocess-run-check
-        cp = runcp(args)  # , capture_output=True, encoding='utf-8'
+        cp = runcp(args, env=env)  # , capture_output=True, encoding='utf-8'
         if cp.returncode == 0:
             return
         assert cp.returncode != 0
+        pause = delay + random.uniform(-0.25, 0.25)
         if _is_docker_build_too_many_requests(cp) and \
-                (time.monotonic() - start_time) < (tmr_timeout - 1):
+                (time.monotonic() - start_time + pause) < tmr_timeout:
             print("Got 'too many requests' error. Will retry...")
-            time.sleep(1)
+            time.sleep(pause)
+            delay = min(delay * 2, 8.0)
             continue
         raise CalledProcessError(cp.returncode, cp.args,
                                  cp.stdout, cp.stderr)
@@ -153,7 +387,7 @@ def docker_run(image_name: str, container_name: str = None,
         port_mapping = None
 
     command = _combine([
-        'docker', 'run', '--rm',
+        _DOCKER, 'run', '--rm',
         '-d' if detach else None,
         ('-p', port_mapping) if port_mapping else None,
         ('--name', container_name) if container_name else None,
@@ -164,14 +398,17 @@ def docker_run(image_name: str, container_name: str = None,
 
 def docker_stop(container_name: str):
     print_header(f"Stopping docker container {container_name}")
-    check_call_rt(('docker', 'container', 'stop', container_name))
+    check_call_rt((_DOCKER, 'container', 'stop', container_name))
+
+
+_ECR_URI_RE = re.compile(r'(.+)/([^@:]+)(?:[@:](.+))?')
 
 
 class EcrRepoUri:
     def __init__(self, uri: str):
         self.uri = uri
 
-        m = re.match(r'(.+)/([^@:]+)(?:[@:](.+))?', uri)
+        m = _ECR_URI_RE.match(uri)
         if m is None:
             raise ValueError(uri)
         self.host = str(m.group(1))
@@ -179,6 +416,12 @@ class EcrRepoUri:
         self.tag = str(m.group(3)) if m.group(3) else None
         self.region = self.host.split('.')[-3]
 
+    @staticmethod
+    def of(uri: str) -> 'EcrRepoUri':
+        """Returns a cached parsed object for the `uri`. The returned object
+        is shared, so it must not be modified."""
+        return _make_ecr(uri)
+
     @property
     def uri_without_tag(self):
         return self.host + '/' + self.name
@@ -187,6 +430,15 @@ class EcrRepoUri:
         return self.uri
 
 
+@functools.lru_cache(maxsize=128)
+def _make_ecr(uri: str) -> EcrRepoUri:
+    return EcrRepoUri(uri)
+
+
+def _as_ecr(uri: Union[str, EcrRepoUri]) -> EcrRepoUri:
+    return uri if isinstance(uri, EcrRepoUri) else EcrRepoUri.of(uri)
+
+
 class TestEcrRepoUri(unittest.TestCase):
     def test_with_tag(self):
         src = '1253812538.dkr.ecr.us-east-1.amazonaws.com/abc_x1:mytag'
@@ -216,7 +468,13 @@ class TestEcrRepoUri(unittest.TestCase):
         self.assertEqual(uri.name, 'imagename')
         self.assertTrue(uri.tag.startswith('sha256:d13b68'))
 
+    def test_of_is_cached(self):
+        src = '1253812538.dkr.ecr.us-east-1.amazonaws.com/abc_x1:mytag'
+        self.assertIs(EcrRepoUri.of(src), EcrRepoUri.of(src))
+        self.assertEqual(EcrRepoUri.of(src).tag, 'mytag')
+
 
+@functools.lru_cache(maxsize=128)
 def ecr_repo_uri_to_region(uri: str) -> str:
     parts = uri.split('/')
     host = next(p for p in parts if p.endswith('.amazonaws.com'))
@@ -227,8 +485,27 @@ assert ecr_repo_uri_to_region(
     "1253812538.dkr.ecr.us-east-1.amazonaws.com/abc") == 'us-east-1'
 
 
+_DIGEST_RE = re.compile(r'digest: (sha256:[0-9a-z]+)')
+_DIGEST_MARKER = 'digest: sha256:'
+_SHA256_DIGEST_LEN = len('sha256:') + 64
+_DIGEST_CHARS = frozenset('0123456789abcdefghijklmnopqrstuvwxyz')
+_HEX_CHARS = frozenset('0123456789abcdef')
+
+
 def _get_digest(output: str) -> str:
-    m = re.search(r'digest: (sha256:[0-9a-z]+)', output)
+    # fast path for the usual full-length digest, without running the regex
+    # over the whole push log
+    idx = output.find(_DIGEST_MARKER)
+    if idx >= 0:
+        start = idx + len('digest: ')
+        end = start + _SHA256_DIGEST_LEN
+        digest = output[start:end]
+        if len(digest) == _SHA256_DIGEST_LEN \
+                and _HEX_CHARS.issuperset(digest[len('sha256:'):]) \
+                and output[end:end + 1] not in _DIGEST_CHARS:
+            return digest
+
+    m = _DIGEST_RE.search(output)
     if not m:
         raise ValueError(m)
     return str(m.group(1))
@@ -243,63 +520,208 @@ class TestGetDigest(unittest.TestCase):
         ''')
         self.assertEqual(s, 'sha256:d4c7852abfabaf3076bd6a84')
 
+    def test_full_length(self):
+        sha = 'sha256:d13b68bf5763e3cf8b9898d4c2b5000ad538e8d4155ef80686e0c3f04322c9af'
+        s = _get_digest(f'95e3c2813def: Pushed\n'
+                        f'latest: digest: {sha} size: 2841\n')
+        self.assertEqual(s, sha)
 
-def ecr_delete_images_by_json(repo_uri: Union[EcrRepoUri, str],
-                              image_ids_in_json: str):
-    if isinstance(repo_uri, str):
-        repo_uri = EcrRepoUri(repo_uri)
 
-    if not json.loads(image_ids_in_json):
-        print("Nothing to delete")
+def _parse_image_ids(js: str) -> List[Dict[str, str]]:
+    # the CLI prints "[]" when there are no images, so the usual case
+    # is decided without parsing
+    stripped = js.strip()
+    if stripped in ('[]', '{}', ''):
+        return []
+    return json.loads(stripped)
+
+
+class TestParseImageIds(unittest.TestCase):
+    def test(self):
+        self.assertEqual(_parse_image_ids('[]\n'), [])
+        self.assertEqual(_parse_image_ids(''), [])
+        self.assertEqual(_parse_image_ids('{}'), [])
+        self.assertEqual(_parse_image_ids('[\n]'), [])
+        self.assertEqual(_parse_image_ids('[{"imageDigest": "sha256:00"}]'),
+                         [{"imageDigest": "sha256:00"}])
+
+
+# batch-delete-image accepts at most 100 ids per call
+_ECR_DELETE_BATCH_SIZE = 100
+
+
+def _split(items: List, size: int) -> List[List]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class TestSplit(unittest.TestCase):
+    def test(self):
+        self.assertEqual(_split([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(_split([1, 2], 2), [[1, 2]])
+        self.assertEqual(_split([], 2), [])
+
+
+def _ecr_batch_delete_images(repo_uri: EcrRepoUri,
+                             image_ids: List[Dict[str, str]],
+                             echo: bool = True):
+    if _use_boto3():
+        response = _ecr_client(repo_uri.region).batch_delete_image(
+            repositoryName=repo_uri.name,
+            imageIds=image_ids)
+        if echo:
+            print(f"Deleted {len(response['imageIds'])} images")
+        for failure in response['failures']:
+            print(f"Failed to delete {failure}")
         return
 
-    check_call_rt(('aws', 'ecr', 'batch-delete-image',
+    # passing the ids through stdin rather than argv, since many ids
+    # may not fit into the command line
+    request = json.dumps({'imageIds': image_ids})
+    check_call_rt((_AWS, 'ecr', 'batch-delete-image',
                    '--region', repo_uri.region,
                    '--repository-name', repo_uri.name,
-                   '--image-ids', image_ids_in_json))
+                   '--cli-input-json', 'file:///dev/stdin'),
+                  input=request.encode(), echo=echo)
 
 
-def ecr_get_untagged_images_json(repo_uri: Union[str, EcrRepoUri]) -> str:
-    if isinstance(repo_uri, str):
-        repo_uri = EcrRepoUri(repo_uri)
+def _ecr_delete_image_ids(repo_uri: EcrRepoUri,
+                          image_ids: List[Dict[str, str]],
+                          echo: bool = True):
+    if not image_ids:
+        if echo:
+            print("Nothing to delete")
+        return
 
-    cp = runcp((
-        'aws', 'ecr', 'list-images',
+    batches = _split(image_ids, _ECR_DELETE_BATCH_SIZE)
+    if len(batches) == 1:
+        _ecr_batch_delete_images(repo_uri, batches[0], echo)
+        return
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(_ecr_batch_delete_images, repo_uri, batch,
+                                   echo)
+                   for batch in batches]
+    errors = [e for e in (f.exception() for f in futures) if e is not None]
+    if errors:
+        print(f"Failed to delete {len(errors)} of {len(batches)} batches")
+        raise errors[0]
+
+
+def ecr_delete_images_by_json(repo_uri: Union[EcrRepoUri, str],
+                              image_ids_in_json: str):
+    ids = _parse_image_ids(image_ids_in_json)
+    if not ids:
+        print("Nothing to delete")
+        return
+
+    _ecr_delete_image_ids(_as_ecr(repo_uri), ids)
+
+
+def _ecr_list_image_ids(repo_uri: EcrRepoUri,
+                        untagged_only: bool,
+                        echo: bool = True) -> List[Dict[str, str]]:
+    # All the ids are listed before any of them is deleted: deleting images
+    # while paginating could shift the pagination cursor.
+    if _use_boto3():
+        paginator = _ecr_client(repo_uri.region).get_paginator('list_images')
+        pages = paginator.paginate(
+            repositoryName=repo_uri.name,
+            filter={'tagStatus': 'UNTAGGED' if untagged_only else 'ANY'},
+            # a page is exactly one batch for batch_delete_image
+            PaginationConfig={'PageSize': _ECR_DELETE_BATCH_SIZE})
+        return [image_id
+                for page in pages
+                for image_id in page['imageIds']]
+
+    js = runcp(_combine([
+        _AWS, 'ecr', 'list-images',
         '--region', repo_uri.region,
         '--repository-name', repo_uri.name,
-        '--filter', "tagStatus=UNTAGGED",
+        ('--filter', "tagStatus=UNTAGGED") if untagged_only else None,
         '--query', 'imageIds[*]',
         '--output', 'json'
+    ]), check=True, echo=echo).stdout
+    return _parse_image_ids(js)
 
-    ), check=True)
 
-    # if cp.returncode != 0:
-    #     raise CalledProcessError(cp.returncode, cp.args,
-    #                              cp.stdout, cp.stderr)
-    return cp.stdout
+def ecr_get_untagged_images_json(repo_uri: Union[str, EcrRepoUri]) -> str:
+    return json.dumps(
+        _ecr_list_image_ids(_as_ecr(repo_uri), untagged_only=True))
 
 
-def ecr_delete_images_untagged(repo_uri: Union[str, EcrRepoUri]):
-    js = ecr_get_untagged_images_json(repo_uri)
-    return ecr_delete_images_by_json(repo_uri, js)
+def ecr_delete_images_untagged(repo_uri: Union[str, EcrRepoUri],
+                               quiet: bool = False):
+    """With `quiet=True` nothing is printed except failures, so it can run
+    alongside another command that writes to stdout."""
+    repo_uri = _as_ecr(repo_uri)
+    echo = not quiet
+    _ecr_delete_image_ids(
+        repo_uri,
+        _ecr_list_image_ids(repo_uri, untagged_only=True, echo=echo),
+        echo=echo)
 
 
 def ecr_delete_images_all(repo_uri: Union[EcrRepoUri, str]):
     print_header(f"Deleting all images from {str(repo_uri)}")
 
-    if isinstance(repo_uri, str):
-        repo_uri = EcrRepoUri(repo_uri)
+    repo_uri = _as_ecr(repo_uri)
+    _ecr_delete_image_ids(
+        repo_uri, _ecr_list_image_ids(repo_uri, untagged_only=False))
 
-    js = check_output((
-        'aws', 'ecr', 'list-images',
-        '--region', repo_uri.region,
-        '--repository-name', repo_uri.name,
-        '--query', 'imageIds[*]',
-        '--output', 'json'
 
-    ), encoding="utf-8")
+# region -> (password, expiration time) of the last ECR authorization token
+_ecr_passwords: Dict[str, Tuple[str, datetime.datetime]] = {}
+_ECR_PASSWORD_MARGIN = datetime.timedelta(minutes=5)
+
+
+def _ecr_password(region: str) -> str:
+    cached = _ecr_passwords.get(region)
+    if cached is not None:
+        password, expires_at = cached
+        if datetime.datetime.now(expires_at.tzinfo) \
+                < expires_at - _ECR_PASSWORD_MARGIN:
+            return password
+
+    auth = _ecr_client(region).get_authorization_token()['authorizationData'][0]
+    _, password = base64.b64decode(auth['authorizationToken']) \
+        .decode().split(':', 1)
+    _ecr_passwords[region] = (password, auth['expiresAt'])
+    return password
+
+
+def _docker_login_to_ecr(repo_uri: EcrRepoUri):
+    login_args = (_DOCKER, 'login',
+                  '--username', 'AWS',
+                  '--password-stdin',
+                  repo_uri.host)
+
+    sys.stdout.flush()
+    if _use_boto3():
+        # the token is reused until it is about to expire, so the second
+        # push in the same run does not request it again
+        subprocess.run(login_args,
+                       input=_ecr_password(repo_uri.region).encode(),
+                       check=True)
+        return
+
+    # The password is piped from one process to another directly, so it
+    # never enters Python. The login output is not captured either.
+    with Popen(
+            (_AWS, 'ecr', 'get-login-password',
+             '--region', repo_uri.region),
+            stdout=PIPE) as get_password:
+        assert get_password.stdout is not None
+        with Popen(login_args, stdin=get_password.stdout) as login:
+            # closing our copy of the pipe, so that only the two processes
+            # hold it, and `aws` gets SIGPIPE if `docker` exits early
+            get_password.stdout.close()
+            login_code = login.wait()
+        password_code = get_password.wait()
 
-    ecr_delete_images_by_json(repo_uri, js)
+    if password_code != 0:
+        raise CalledProcessError(password_code, get_password.args)
+    if login_code != 0:
+        raise CalledProcessError(login_code, login.args)
 
 
 def docker_push_to_ecr(docker_image: str,
@@ -315,29 +737,22 @@ def docker_push_to_ecr(docker_image: str,
     The function returns the second one.
     """
 
-    if isinstance(repo_uri, str):
-        repo_uri = EcrRepoUri(repo_uri)
+    repo_uri = _as_ecr(repo_uri)
 
-    with Popen(
-            ('aws', 'ecr', 'get-login-password',
-             '--region', repo_uri.region),
-            stdout=PIPE) as get_password:
-        check_call_rt(
-            ('docker', 'login',
-             '--username', 'AWS',
-             '--password-stdin',
-             repo_uri.host),
-            stdin=get_password.stdout)
-
-    check_call_rt((
-        'docker', 'tag', docker_image,
-        # repo_uri.uri_without_tag ?!
-        repo_uri.uri
-    ))
+    # tagging only touches the local daemon, so it does not depend on
+    # the login and runs on this thread while the login is in progress
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        login = executor.submit(_docker_login_to_ecr, repo_uri)
+        check_call_rt((
+            _DOCKER, 'tag', docker_image,
+            # repo_uri.uri_without_tag ?!
+            repo_uri.uri
+        ))
+        login.result()
 
     # pylint: disable=subprocess-run-check
     cp = runcp((
-        'docker', 'push', repo_uri.uri
+        _DOCKER, 'push', repo_uri.uri
     ))
     if cp.returncode != 0:
         print("Captured before error:")
@@ -351,19 +766,87 @@ def docker_push_to_ecr(docker_image: str,
     return alternate_image_uri
 
 
+def ecr_tag_image(image_uri: Union[EcrRepoUri, str], new_tag: str):
+    """Adds `new_tag` to an image that is already in the ECR repository,
+    without pulling or pushing any layers.
+
+    :param image_uri: '1253812538.dkr.ecr.us-east-1.amazonaws.com/abc:mytag'
+        or '1253812538.dkr.ecr.us-east-1.amazonaws.com/abc@sha256:...'
+    """
+    image_uri = _as_ecr(image_uri)
+    if image_uri.tag is None:
+        raise ValueError(f"No tag or digest in {image_uri}")
+    if image_uri.tag.startswith('sha256:'):
+        image_id = {'imageDigest': image_uri.tag}
+    else:
+        image_id = {'imageTag': image_uri.tag}
+
+    print(f"Tagging {image_uri} as {new_tag}")
+
+    client = _ecr_client(image_uri.region) if _use_boto3() else None
+    if client is not None:
+        images = client.batch_get_image(repositoryName=image_uri.name,
+                                        imageIds=[image_id])['images']
+    else:
+        images = json.loads(runcp((
+            _AWS, 'ecr', 'batch-get-image',
+            '--region', image_uri.region,
+            '--repository-name', image_uri.name,
+            '--image-ids', ','.join(f'{k}={v}' for k, v in image_id.items()),
+            '--output', 'json'
+        ), check=True).stdout)['images']
+    if not images:
+        raise ValueError(f"Image {image_uri} not found")
+
+    request = {'imageManifest': images[0]['imageManifest'],
+               'imageTag': new_tag}
+    if 'imageManifestMediaType' in images[0]:
+        request['imageManifestMediaType'] = images[0]['imageManifestMediaType']
+
+    # ECR refuses to put the same manifest with the same tag again,
+    # which means the image is already tagged
+    if client is not None:
+        try:
+            client.put_image(repositoryName=image_uri.name, **request)
+        except client.exceptions.ImageAlreadyExistsException:
+            pass
+    else:
+        cp = runcp((
+            _AWS, 'ecr', 'put-image',
+            '--region', image_uri.region,
+            '--repository-name', image_uri.name,
+            '--cli-input-json', 'file:///dev/stdin'
+        ), input=json.dumps(request).encode())
+        if cp.returncode != 0 \
+                and 'ImageAlreadyExistsException' not in cp.stdout:
+            raise CalledProcessError(cp.returncode, cp.args, cp.stdout)
+
+
 def lambda_function_wait_updated(aws_region: str, func_name: str):
     # Waits for the function's LastUpdateStatus to be Successful.
-    # It will poll every 5 seconds until a successful state has
+    # The CLI will poll every 5 seconds until a successful state has
     # been reached. This will exit with a return code of 255 after
-    # 60 failed checks
+    # 60 failed checks. With boto3 we poll every 2 seconds for the same
+    # 300 seconds, since most updates take just a few seconds
     print(f"Waiting for successful update status "
           f"of {func_name} at {aws_region}", flush=True)
+    if _use_boto3():
+        _lambda_client(aws_region).get_waiter('function_updated').wait(
+            FunctionName=func_name,
+            WaiterConfig={'Delay': 2, 'MaxAttempts': 150})
+        return
     check_call_rt((
-        'aws', 'lambda', 'wait', 'function-updated',
+        _AWS, 'lambda', 'wait', 'function-updated',
         '--region', aws_region,
         '--function-name', func_name))
 
 
+# (region, function name) -> time.monotonic() when the last update
+# made by this process was confirmed successful
+_last_update_ok: Dict[Tuple[str, str], float] = {}
+_SKIP_PRE_WAIT_SECONDS = 10
+
+
 def lambda_function_update(aws_region: str, func_name: str,
                            ecr_image_uri: Union[EcrRepoUri, str]):
     # ecr_image_uri can be an uri with hash code:
@@ -377,20 +860,47 @@ def lambda_function_update(aws_region: str, func_name: str,
 
     # when we call update-function-code twice in a row,
     # we can get "The operation cannot be performed at this time.
-    # An update is in progress for resource". So we'll wait here...
-    lambda_function_wait_updated(aws_region, func_name)
-
-    check_call_rt((
-        'aws', 'lambda', 'update-function-code',
-        '--region', aws_region,
-        '--function-name', func_name,
-        '--image-uri', ecr_image_uri
-    ))
+    # An update is in progress for resource"
+    key = (aws_region, func_name)
+
+    if _use_boto3():
+        # with boto3 the conflict is a distinct exception, so we only wait
+        # when there actually is an update in progress. _last_update_ok
+        # is only written on this path, never read
+        client = _lambda_client(aws_region)
+        try:
+            client.update_function_code(FunctionName=func_name,
+                                        ImageUri=ecr_image_uri)
+        except client.exceptions.ResourceConflictException:
+            lambda_function_wait_updated(aws_region, func_name)
+            client.update_function_code(FunctionName=func_name,
+                                        ImageUri=ecr_image_uri)
+    else:
+        # so we'll wait here... unless we have just waited for this very
+        # function ourselves
+        recently_updated = \
+            time.monotonic() - _last_update_ok.get(key, -math.inf) \
+            < _SKIP_PRE_WAIT_SECONDS
+        if not recently_updated:
+            lambda_function_wait_updated(aws_region, func_name)
+        check_call_rt((
+            _AWS, 'lambda', 'update-function-code',
+            '--region', aws_region,
+            '--function-name', func_name,
+            '--image-uri', ecr_image_uri
+        ))
 
     lambda_function_wait_updated(aws_region, func_name)
+    _last_update_ok[key] = time.monotonic()
     print(f"Function {func_name} updated")
 
 
+class _CredentialsFileCache:
+    # set when the default credentials file is known to exist
+    verified = False
+
+
+@functools.lru_cache(maxsize=1)
 def aws_get_default_credentials_file_path() -> Path:
     # https://docs.aws.amazon.com/cli/latest/userguide/cli-configure-files.html
     # 2021: The credentials file is located at ~/.aws/credentials on Linux or macOS,
@@ -399,6 +909,11 @@ def aws_get_default_credentials_file_path() -> Path:
     return Path.home() / '.aws' / 'credentials'
 
 
+_CREDENTIALS_TEMPLATE = ('[default]\n'
+                         'aws_access_key_id = %s\n'
+                         'aws_secret_access_key = %s\n')
+
+
 def aws_create_credentials_file(
         access_key_id: str,
         secret_access_key: str,
@@ -408,18 +923,29 @@ def aws_create_credentials_file(
 
     file = file or aws_get_default_credentials_file_path()
 
-    if not overwrite and file.exists():
-        raise FileExistsError
     file.parent.mkdir(exist_ok=True, parents=True)
-    txt = f'''
-        [default]
-        aws_access_key_id = {access_key_id}
-        aws_secret_access_key = {secret_access_key}
-    '''
-    file.write_text(textwrap.dedent(txt).strip())
+    # the exclusive mode raises FileExistsError if the file exists
+    with file.open('w' if overwrite else 'x') as f:
+        f.write(_CREDENTIALS_TEMPLATE % (access_key_id, secret_access_key))
     return file
 
 
+class TestCreateCredentialsFile(unittest.TestCase):
+    def test(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / '.aws' / 'credentials'
+            aws_create_credentials_file('id1', 'secret1', file=file)
+            self.assertEqual(file.read_text(),
+                             '[default]\n'
+                             'aws_access_key_id = id1\n'
+                             'aws_secret_access_key = secret1\n')
+            with self.assertRaises(FileExistsError):
+                aws_create_credentials_file('id2', 'secret2', file=file)
+            aws_create_credentials_file('id2', 'secret2', file=file,
+                                        overwrite=True)
+            self.assertIn('id2', file.read_text())
+
+
 def aws_create_credentials_file_on_need(
         access_key_id: Optional[str],
         secret_access_key: Optional[str]) -> Path:
@@ -434,6 +960,8 @@ def aws_create_credentials_file_on_need(
             os.environ.get("AWS_MY_SECRET_ACCESS_KEY"))
     """
     aws_cred_file = aws_get_default_credentials_file_path()
+    if _CredentialsFileCache.verified:
+        return aws_cred_file
     if not aws_cred_file.exists():
         if access_key_id is None:
             raise ValueError('access_key_id is None, '
@@ -442,9 +970,18 @@ def aws_create_credentials_file_on_need(
             raise ValueError('secret_access_key is None, '
                              'and no credentials file')
         aws_create_credentials_file(access_key_id, secret_access_key)
-    assert aws_cred_file.exists()
+        assert aws_cred_file.exists()
+    _CredentialsFileCache.verified = True
     return aws_cred_file
 
 
+def aws_invalidate_credentials_cache() -> None:
+    """Forgets the cached location and existence of the default credentials
+    file. Long-running processes may call it when the home directory or the
+    file could have changed."""
+    aws_get_default_credentials_file_path.cache_clear()
+    _CredentialsFileCache.verified = False
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,13 +1,14 @@
 # SPDX-FileCopyrightText: (c) 2021 Artёm IG <github.com/rtmigo>
 # SPDX-License-Identifier: MIT
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum, auto
 from pathlib import Path
-from typing import Callable, Union
+from typing import Callable, Union, Dict, Optional
 
 from ._cli_methods import methods_cli
 from ._funcs import docker_build, docker_push_to_ecr, \
-    ecr_delete_images_untagged, lambda_function_update, \
-    EcrRepoUri
+    ecr_delete_images_untagged, ecr_tag_image, lambda_function_update, \
+    EcrRepoUri, _docker_login_to_ecr
 
 
 class Stage(IntEnum):
@@ -39,11 +40,9 @@ class LambdaDockerPipeline:
 
         self.docker_image_name = docker_image_name
 
-        if aws_region:
-            self.aws_region = aws_region
-        else:
-            self.aws_region = ecr_host.split('.')[-3]
-            assert self.aws_region[-1].isdigit()  # "us-east-1"
+        self._ecr_region = ecr_host.split('.')[-3]
+        assert self._ecr_region[-1].isdigit()  # "us-east-1"
+        self.aws_region = aws_region or self._ecr_region
 
         self.ecr_host = ecr_host
         self.ecr_repo_name = ecr_repo_name
@@ -52,11 +51,21 @@ class LambdaDockerPipeline:
         self.lambda_func_name_dev = lambda_func_name_dev
         self.lambda_func_name_prod = lambda_func_name_prod
 
+        self._ecr_image_uris: Dict[Stage, EcrRepoUri] = {
+            stage: EcrRepoUri.of(f"{ecr_host}/{ecr_repo_name}:{stage.name}")
+            for stage in (Stage.dev, Stage.prod)}
+        self._lambda_func_names: Dict[Stage, str] = {
+            Stage.dev: lambda_func_name_dev,
+            Stage.prod: lambda_func_name_prod}
+
         if docker_file is None:
             self.docker_file = Path(f'{docker_source_dir}/Dockerfile')
         else:
             self.docker_file = Path(docker_file)
 
+        # the digest URI of the image pushed by _push_container
+        self._pushed_image_uri: Optional[str] = None
+
     def header(self, s: str) -> None:
         print()
         print('/' * 80)
@@ -66,41 +75,57 @@ class LambdaDockerPipeline:
 
     @property
     def ecr_region(self):
-        return self.ecr_host.split('.')[-3]
+        return self._ecr_region
 
-    def _build_container(self):
+    def _build_container(self, use_ecr_cache: bool = False):
         self.header("Building Docker image")
+        cache_from = None
+        if use_ecr_cache:
+            # reusing the layers of the last dev image, that makes builds
+            # on clean CI workers much faster. Pulling the layers requires
+            # a login, and the push will need it anyway
+            dev_uri = self._ecr_image_uri(Stage.dev)
+            _docker_login_to_ecr(dev_uri)
+            cache_from = str(dev_uri)
         docker_build(image_name=self.docker_image_name,
                      docker_file=self.docker_file,
-                     source_dir=Path('.'))
+                     source_dir=Path('.'),
+                     cache_from=cache_from)
 
     def _ecr_image_uri(self, stage: Stage) -> EcrRepoUri:
-        if stage == Stage.dev:
-            return EcrRepoUri(f"{self.ecr_host}/{self.ecr_repo_name}:dev")
-        elif stage == Stage.prod:
-            return EcrRepoUri(f"{self.ecr_host}/{self.ecr_repo_name}:prod")
-        else:
-            raise ValueError(stage)
+        try:
+            return self._ecr_image_uris[stage]
+        except KeyError:
+            raise ValueError(stage) from None
 
-    def _lambda_func_name(self, stage: Stage):
-        if stage == Stage.dev:
-            return self.lambda_func_name_dev
-        elif stage == Stage.prod:
-            return self.lambda_func_name_prod
-        else:
-            raise ValueError(stage)
+    def _lambda_func_name(self, stage: Stage) -> str:
+        try:
+            return self._lambda_func_names[stage]
+        except KeyError:
+            raise ValueError(stage) from None
 
     def _push_container(self, stage: Stage):
         # pushes the last built image to Amazon ECR
         self.header(f"Pushing Docker image {stage.name}")
 
-        docker_push_to_ecr(
+        self._pushed_image_uri = docker_push_to_ecr(
             docker_image=self.docker_image_name,
             repo_uri=self._ecr_image_uri(stage))
 
+    def _tag_pushed_container(self, stage: Stage):
+        # the image pushed for the previous stage is already in the
+        # repository, so it only needs a new tag there
+        if self._pushed_image_uri is None:
+            self._push_container(stage)
+            return
+        self.header(f"Tagging Docker image {stage.name}")
+        ecr_tag_image(self._pushed_image_uri,
+                      str(self._ecr_image_uri(stage).tag))
+
     def _delete_untagged_ecr_images(self):
         self.header('Deleting untagged ECR images')
-        ecr_delete_images_untagged(self.ecr_repo_name)
+        # the repository URI (not only the name) is needed to know the region
+        ecr_delete_images_untagged(f"{self.ecr_host}/{self.ecr_repo_name}")
 
     def _update_function(self, stage: Stage):
         func_name = self._lambda_func_name(stage)
@@ -112,10 +137,18 @@ class LambdaDockerPipeline:
         print(f"Image: {image}")
         print()
 
-        print("Removing untagged images from ECR...")
-        ecr_delete_images_untagged(image.uri_without_tag)
-
-        lambda_function_update(self.aws_region, func_name, image)
+        # the function is updated to the tagged image, so removing untagged
+        # images does not affect the update and can run at the same time.
+        # The removal is quiet, so that only the update writes to stdout
+        print("Removing untagged images from ECR in background...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            cleanup = executor.submit(ecr_delete_images_untagged,
+                                      image.uri_without_tag, quiet=True)
+            update = executor.submit(lambda_function_update,
+                                     self.aws_region, func_name, image)
+            update.result()
+            cleanup.result()
+        print("Untagged images removed from ECR")
 
     def _print_not_overridden(self, method: Callable):
         print(
@@ -146,7 +179,7 @@ class LambdaDockerPipeline:
     def build_dev(self):
         self.test_local()
 
-        self._build_container()
+        self._build_container(use_ecr_cache=True)
         self.test_docker()
 
         self._push_container(Stage.dev)
@@ -155,7 +188,7 @@ class LambdaDockerPipeline:
 
     def build_prod(self):
         self.build_dev()
-        self._push_container(Stage.prod)
+        self._tag_pushed_container(Stage.prod)
         self._update_function(Stage.prod)
         self.test_prod()
 
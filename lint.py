@@ -2,15 +2,29 @@ import subprocess
 
 
 def lint():
-    print("Running pylint...")
-    r = subprocess.call(['pylint', 'awscmds'])
+    # pylint and mypy are independent, so they run at the same time.
+    # The outputs are buffered and printed one after another
+    print("Running pylint and mypy...")
+    pylint = subprocess.Popen(['pylint', 'awscmds'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+    mypy = subprocess.Popen(['mypy', 'awscmds',
+                             '--ignore-missing-imports'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    pylint_output, _ = pylint.communicate()
+    mypy_output, _ = mypy.communicate()
+
+    print("Pylint:")
+    print(pylint_output.decode(errors='replace'))
+    print("Mypy:")
+    print(mypy_output.decode(errors='replace'))
+
+    r = pylint.returncode
     if r & 1 or r & 2 or r & 32:
         exit(1)
-
-    print("Running mypy...")
-    if subprocess.call(['mypy', 'awscmds',
-                        '--ignore-missing-imports']) != 0:
+    if mypy.returncode != 0:
         exit(1)
 
 if __name__ == "__main__":
-    lint()
\ No newline at end of file
+    lint()
@@ -1,3 +1,4 @@
+import re
 from pathlib import Path
 from typing import Dict, Any
 
@@ -5,21 +6,19 @@ from setuptools import setup
 
 
 def load_constants(pattern='*/_constants.py') -> Dict[str, Any]:
-    """Finds in the parent dir a single file by the pattern and imports module
-    from it. Returns the dictionary of globals defined in the module."""
-    import importlib.util as ilu
+    """Finds in the parent dir a single file by the pattern and reads
+    the constants from it without importing the module. Returns
+    the dictionary with `__version__`."""
 
     # finding the _constants.py (or anything defined by the pattern)
     candidates = list(Path(__file__).parent.glob(pattern))
     assert len(candidates) == 1, f"Candidates: {candidates}"
     filename = candidates[0]
 
-    # importing module from `filename`
-    spec = ilu.spec_from_file_location('', filename)
-    module = ilu.module_from_spec(spec)
-    # noinspection Mypy
-    spec.loader.exec_module(module)
-    return module.__dict__
+    text = filename.read_text()
+    m = re.search(r'''^__version__\s*=\s*["']([^"']+)''', text, re.M)
+    assert m is not None, f"No __version__ in {filename}"
+    return {'__version__': m.group(1)}
 
 
 constants = load_constants()
@@ -33,6 +32,11 @@ setup(
 
     packages=['awscmds'],
 
+    extras_require={
+        # optional: replaces the `aws` CLI calls with in-process clients
+        'boto3': ['boto3'],
+    },
+
     description="",
 
     keywords="amazon aws cli docker".split(),
@@ -2,22 +2,33 @@ from chkpkg import Package
 
 if __name__ == "__main__":
     with Package() as pkg:
-        for name in ['docker_build',
-                     'docker_stop',
-                     'docker_push_to_ecr',
-                     'docker_run',
-                     'lambda_function_update',
-                     'lambda_function_wait_updated',
-                     'ecr_delete_images_all',
-                     'ecr_delete_images_by_json',
-                     'print_header',
-                     'set_header_prefix',
-                     'aws_create_credentials_file',
-                     'aws_get_default_credentials_file_path',
-                     'aws_create_credentials_file_on_need',
-                     'runcp',
-                     'LambdaDockerPipeline',
-                     'Stage']:
-            pkg.run_python_code(f'from awscmds import {name}')
+        names = ['docker_build',
+                 'docker_stop',
+                 'docker_push_to_ecr',
+                 'docker_run',
+                 'lambda_function_update',
+                 'lambda_function_wait_updated',
+                 'ecr_delete_images_all',
+                 'ecr_delete_images_by_json',
+                 'ecr_tag_image',
+                 'print_header',
+                 'set_header_prefix',
+                 'aws_create_credentials_file',
+                 'aws_get_default_credentials_file_path',
+                 'aws_create_credentials_file_on_need',
+                 'aws_invalidate_credentials_cache',
+                 'runcp',
+                 'runcp_async',
+                 'set_use_boto3',
+                 'LambdaDockerPipeline',
+                 'Stage']
+        # one interpreter for all the names; if it fails, importing them
+        # one by one tells which name is missing
+        try:
+            pkg.run_python_code('from awscmds import ' + ', '.join(names))
+        except Exception:
+            for name in names:
+                pkg.run_python_code(f'from awscmds import {name}')
+            raise
 
     print("\nPackage is OK!")